@@ -4,12 +4,16 @@ Auto-downloads YOLO model if missing
 Receives image URL, performs detection, returns annotated image URL
 """
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 import requests
 from PIL import Image
 import io
+import math
 import numpy as np
 from ultralytics import YOLO
 import cloudinary
@@ -18,18 +22,12 @@ import os
 from dotenv import load_dotenv
 import torch
 import logging
-import sys
-import traceback
-
-# Configure comprehensive logging
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-        logging.FileHandler('detection.log', mode='a')
-    ]
-)
+from instrumentation import StageTimer, metrics_payload, setup_logging
+from roi import RoadMaskCache, compute_roi
+from detection_store import DetectionRecord, DetectionStore, MAX_PAGE_SIZE
+
+# Configure non-blocking, sampled logging
+setup_logging()
 logger = logging.getLogger(__name__)
 
 # ⚠️ FIX: Patch torch.load for PyTorch 2.6+ compatibility
@@ -70,8 +68,7 @@ try:
     logger.info("☁️ Cloudinary configured successfully")
     logger.info(f"   Cloud name: {os.getenv('CLOUDINARY_CLOUD_NAME')}")
 except Exception as e:
-    logger.error(f"❌ Cloudinary configuration failed: {e}")
-    logger.error(f"   Full traceback: {traceback.format_exc()}")
+    logger.exception("❌ Cloudinary configuration failed: %s", e)
     raise
 
 # -------------------------
@@ -91,8 +88,7 @@ def download_model():
                 f.write(chunk)
         logger.info("✅ Model downloaded successfully")
     except Exception as e:
-        logger.error(f"❌ Model download failed: {e}")
-        logger.error(f"   Full traceback: {traceback.format_exc()}")
+        logger.exception("❌ Model download failed: %s", e)
         raise
 
 # Download if missing
@@ -110,16 +106,32 @@ try:
     logger.info(f"✅ Model loaded successfully on device: {DEVICE}")
     logger.info(f"   Model classes: {model.names}")
 except Exception as e:
-    logger.error(f"❌ Failed to load model: {e}")
-    logger.error(f"   Full traceback: {traceback.format_exc()}")
+    logger.exception("❌ Failed to load model: %s", e)
     raise
 
+# Per-camera road masks (polygons from ROI_CAMERA_CONFIG, else heuristic)
+roi_cache = RoadMaskCache()
+logger.info(f"🛣️ ROI camera polygons loaded: {len(roi_cache.camera_polygons)}")
+
+# Detection result store (SQLite, WAL, batched background writes)
+store = DetectionStore()
+logger.info(f"🗄️ Detection store opened: {store.path}")
+
 
 # -------------------------
 # API Models
 # -------------------------
 class DetectionRequest(BaseModel):
     imageUrl: str
+    # Optional road ROI, enabled by useRoi or roiPolygon: an explicit
+    # normalised polygon, else the cameraId's configured polygon, else the
+    # road-colour heuristic. cameraId alone never crops the frame.
+    useRoi: bool = False
+    cameraId: str | None = None
+    roiPolygon: list[list[float]] | None = None
+    # Optional capture location, stored with each detection
+    latitude: float | None = Field(None, ge=-90, le=90)
+    longitude: float | None = Field(None, ge=-180, le=180)
 
 
 class BBox(BaseModel):
@@ -129,12 +141,39 @@ class BBox(BaseModel):
     height: float
 
 
+class RoiStats(BaseModel):
+    source: str
+    bounds: list[int]
+    pixelReduction: float
+    estimatedSpeedup: float
+    inferenceMs: float
+
+
 class DetectionResponse(BaseModel):
     detected: bool
     confidence: float = 0.0
     bbox: BBox | None = None
     annotatedImageUrl: str | None = None
     detectedClass: str = "pothole"
+    roi: RoiStats | None = None
+
+
+def _json_safe(value):
+    """Replace NaN/inf (not valid JSON) with their string form"""
+    if isinstance(value, float) and not math.isfinite(value):
+        return str(value)
+    if isinstance(value, dict):
+        return {k: _json_safe(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_json_safe(v) for v in value]
+    return value
+
+
+@app.exception_handler(RequestValidationError)
+async def validation_error_handler(request: Request, exc: RequestValidationError):
+    # The default handler echoes inputs back, so a NaN/Infinity JSON body
+    # value turned a 422 into a 500 while rendering the error
+    return JSONResponse(status_code=422, content={"detail": _json_safe(jsonable_encoder(exc.errors()))})
 
 
 # -------------------------
@@ -152,148 +191,254 @@ def root():
 
 @app.post("/detect", response_model=DetectionResponse)
 async def detect_pothole(request: DetectionRequest):
-    logger.info(f"🔍 Starting detection for image: {request.imageUrl}")
-    
+    logger.info("🔍 Starting detection for image: %s", request.imageUrl)
+    timer = StageTimer("detect")
+    outcome = "error"
+
     try:
         # 1. Download image
         logger.debug("📥 Step 1: Downloading image...")
-        try:
-            response = requests.get(request.imageUrl, timeout=15)
-            response.raise_for_status()
-            logger.info(f"✅ Image downloaded successfully. Size: {len(response.content)} bytes")
-            logger.debug(f"   Content type: {response.headers.get('content-type')}")
-        except Exception as e:
-            logger.error(f"❌ Image download failed: {e}")
-            logger.error(f"   URL: {request.imageUrl}")
-            logger.error(f"   Full traceback: {traceback.format_exc()}")
-            raise HTTPException(400, f"Image download failed: {str(e)}")
+        with timer.stage("download"):
+            try:
+                response = requests.get(request.imageUrl, timeout=15)
+                response.raise_for_status()
+                logger.info("✅ Image downloaded successfully. Size: %d bytes", len(response.content))
+                logger.debug("   Content type: %s", response.headers.get('content-type'))
+            except Exception as e:
+                logger.exception("❌ Image download failed: %s (URL: %s)", e, request.imageUrl)
+                raise HTTPException(400, f"Image download failed: {str(e)}")
 
         # 2. Load and convert image
         logger.debug("🖼️ Step 2: Loading and converting image...")
-        try:
-            image = Image.open(io.BytesIO(response.content)).convert("RGB")
-            image_array = np.array(image)
-            logger.info(f"✅ Image loaded. Dimensions: {image.size}, Array shape: {image_array.shape}")
-        except Exception as e:
-            logger.error(f"❌ Image processing failed: {e}")
-            logger.error(f"   Full traceback: {traceback.format_exc()}")
-            raise HTTPException(400, f"Image processing failed: {str(e)}")
+        with timer.stage("decode"):
+            try:
+                image = Image.open(io.BytesIO(response.content)).convert("RGB")
+                image_array = np.array(image)
+                logger.info("✅ Image loaded. Dimensions: %s, Array shape: %s", image.size, image_array.shape)
+            except Exception as e:
+                logger.exception("❌ Image processing failed: %s", e)
+                raise HTTPException(400, f"Image processing failed: {str(e)}")
+
+        # 2b. Optional road ROI crop
+        roi = None
+        infer_array = image_array
+        if request.useRoi or request.roiPolygon:
+            logger.debug("🛣️ Step 2b: Computing road ROI...")
+            with timer.stage("roi"):
+                try:
+                    if request.roiPolygon:
+                        roi = compute_roi(image_array, request.roiPolygon)
+                    else:
+                        # Configured cameras reuse a cached polygon mask;
+                        # anything else gets a fresh heuristic mask
+                        roi = roi_cache.for_camera(request.cameraId, image_array) or compute_roi(image_array)
+                    infer_array = roi.crop(image_array)
+                    logger.info("✅ ROI (%s) bounds: %s, pixel reduction: %.1f%%",
+                                roi.source, roi.bounds, roi.pixel_reduction * 100)
+                except Exception as e:
+                    logger.exception("❌ ROI computation failed: %s", e)
+                    raise HTTPException(400, f"ROI computation failed: {str(e)}")
 
         # 3. Run YOLO detection
         logger.debug("🤖 Step 3: Running YOLO prediction...")
-        try:
-            results = model.predict(
-                image_array,
-                device=DEVICE,
-                conf=0.20,
-                verbose=False
-            )
-            logger.info(f"✅ YOLO prediction completed. Results count: {len(results)}")
-            if len(results) > 0:
-                logger.debug(f"   Detections in result 0: {len(results[0].boxes)}")
-        except Exception as e:
-            logger.error(f"❌ YOLO prediction failed: {e}")
-            logger.error(f"   Input shape: {image_array.shape}")
-            logger.error(f"   Input dtype: {image_array.dtype}")
-            logger.error(f"   Full traceback: {traceback.format_exc()}")
-            raise HTTPException(500, f"Model prediction failed: {str(e)}")
+        with timer.stage("inference"):
+            try:
+                results = model.predict(
+                    infer_array,
+                    device=DEVICE,
+                    conf=0.20,
+                    verbose=False
+                )
+                logger.info("✅ YOLO prediction completed. Results count: %d", len(results))
+                if len(results) > 0:
+                    logger.debug("   Detections in result 0: %d", len(results[0].boxes))
+            except Exception as e:
+                logger.exception("❌ YOLO prediction failed: %s (input shape: %s, dtype: %s)",
+                                 e, infer_array.shape, infer_array.dtype)
+                raise HTTPException(500, f"Model prediction failed: {str(e)}")
 
         # 4. Process detection results
         logger.debug("📊 Step 4: Processing detection results...")
-        if len(results[0].boxes) == 0:
-            logger.info("⚠️ No potholes detected")
-            return DetectionResponse(detected=False)
-
-        boxes = results[0].boxes
-        logger.info(f"🎯 Found {len(boxes)} detections")
-
-        # Pick best detection
-        best_idx = boxes.conf.argmax()
-        best_box = boxes[best_idx]
-
-        confidence = float(best_box.conf[0])
-        class_id = int(best_box.cls[0])
-        class_name = results[0].names[class_id]
-
-        logger.info(f"🔍 Best detection: {class_name} (confidence: {confidence:.2f})")
-
-        # 5. Extract bounding box
-        logger.debug("📐 Step 5: Extracting bounding box...")
-        try:
-            x1, y1, x2, y2 = best_box.xyxy[0].tolist()
-            bbox = BBox(
-                x=float(x1),
-                y=float(y1),
-                width=float(x2 - x1),
-                height=float(y2 - y1),
-            )
-            logger.debug(f"   BBox: x={x1:.1f}, y={y1:.1f}, w={x2-x1:.1f}, h={y2-y1:.1f}")
-        except Exception as e:
-            logger.error(f"❌ Bounding box extraction failed: {e}")
-            logger.error(f"   Box data: {best_box}")
-            logger.error(f"   Full traceback: {traceback.format_exc()}")
-            raise HTTPException(500, f"Bounding box extraction failed: {str(e)}")
+        with timer.stage("postprocess"):
+            result = results[0]
+            roi_stats = None
+            if roi is not None:
+                # Drop boxes lying mostly outside a camera polygon
+                keep = [roi.contains(roi.to_original(b)) for b in result.boxes.xyxy.tolist()]
+                result = result[torch.as_tensor(keep, dtype=torch.bool)]
+                roi_stats = RoiStats(
+                    source=roi.source,
+                    bounds=list(roi.bounds),
+                    pixelReduction=round(roi.pixel_reduction, 4),
+                    estimatedSpeedup=round(roi.estimated_speedup, 2),
+                    inferenceMs=round(timer.timings["inference"] * 1000, 2),
+                )
+
+            if len(result.boxes) == 0:
+                logger.info("⚠️ No potholes detected")
+                outcome = "no_detection"
+                return DetectionResponse(detected=False, roi=roi_stats)
+
+            boxes = result.boxes
+            logger.info("🎯 Found %d detections", len(boxes))
+
+            # Every kept box in frame coordinates, persisted after upload
+            records = []
+            for xyxy, conf, cls in zip(boxes.xyxy.tolist(), boxes.conf.tolist(), boxes.cls.tolist()):
+                if roi is not None:
+                    xyxy = roi.to_original(xyxy)
+                records.append(DetectionRecord(
+                    source="image",
+                    label=result.names[int(cls)],
+                    confidence=conf,
+                    bbox=tuple(xyxy),
+                    source_ref=request.imageUrl,
+                    latitude=request.latitude,
+                    longitude=request.longitude,
+                ))
+
+            # Pick best detection
+            best_idx = boxes.conf.argmax()
+            best_box = boxes[best_idx]
+
+            confidence = float(best_box.conf[0])
+            class_id = int(best_box.cls[0])
+            class_name = result.names[class_id]
+
+            logger.info("🔍 Best detection: %s (confidence: %.2f)", class_name, confidence)
+
+            # 5. Extract bounding box
+            logger.debug("📐 Step 5: Extracting bounding box...")
+            try:
+                x1, y1, x2, y2 = best_box.xyxy[0].tolist()
+                if roi is not None:
+                    x1, y1, x2, y2 = roi.to_original([x1, y1, x2, y2])
+                bbox = BBox(
+                    x=float(x1),
+                    y=float(y1),
+                    width=float(x2 - x1),
+                    height=float(y2 - y1),
+                )
+                logger.debug("   BBox: x=%.1f, y=%.1f, w=%.1f, h=%.1f", x1, y1, x2 - x1, y2 - y1)
+            except Exception as e:
+                logger.exception("❌ Bounding box extraction failed: %s (box data: %s)", e, best_box)
+                raise HTTPException(500, f"Bounding box extraction failed: {str(e)}")
 
         # 6. Generate annotated image
         logger.debug("🎨 Step 6: Generating annotated image...")
-        try:
-            annotated_img = results[0].plot()
-            annotated_pil = Image.fromarray(annotated_img)
-            logger.debug(f"   Annotated image shape: {annotated_img.shape}")
-            logger.debug(f"   PIL image size: {annotated_pil.size}")
-        except Exception as e:
-            logger.error(f"❌ Image annotation failed: {e}")
-            logger.error(f"   Full traceback: {traceback.format_exc()}")
-            raise HTTPException(500, f"Image annotation failed: {str(e)}")
+        with timer.stage("render"):
+            try:
+                annotated_img = result.plot()
+                if roi is not None:
+                    # Paste the annotated crop back into the full frame
+                    rx0, ry0, rx1, ry1 = roi.bounds
+                    full_img = image_array.copy()
+                    full_img[ry0:ry1, rx0:rx1] = annotated_img
+                    annotated_img = full_img
+                annotated_pil = Image.fromarray(annotated_img)
+                logger.debug("   Annotated image shape: %s", annotated_img.shape)
+            except Exception as e:
+                logger.exception("❌ Image annotation failed: %s", e)
+                raise HTTPException(500, f"Image annotation failed: {str(e)}")
 
         # 7. Convert to buffer
         logger.debug("💾 Step 7: Converting image to buffer...")
-        try:
-            buffer = io.BytesIO()
-            annotated_pil.save(buffer, format="JPEG", quality=95)
-            buffer.seek(0)
-            buffer_size = len(buffer.getvalue())
-            logger.debug(f"   Buffer size: {buffer_size} bytes")
-        except Exception as e:
-            logger.error(f"❌ Buffer conversion failed: {e}")
-            logger.error(f"   Full traceback: {traceback.format_exc()}")
-            raise HTTPException(500, f"Buffer conversion failed: {str(e)}")
+        with timer.stage("encode"):
+            try:
+                buffer = io.BytesIO()
+                annotated_pil.save(buffer, format="JPEG", quality=95)
+                buffer_size = buffer.tell()
+                buffer.seek(0)
+                logger.debug("   Buffer size: %d bytes", buffer_size)
+            except Exception as e:
+                logger.exception("❌ Buffer conversion failed: %s", e)
+                raise HTTPException(500, f"Buffer conversion failed: {str(e)}")
 
         # 8. Upload to Cloudinary
         logger.debug("☁️ Step 8: Uploading to Cloudinary...")
-        try:
-            upload = cloudinary.uploader.upload(
-                buffer,
-                folder="pothole-detections",
-                resource_type="image"
-            )
-            annotated_url = upload["secure_url"]
-            logger.info(f"✅ Cloudinary upload successful: {annotated_url}")
-            logger.debug(f"   Upload response keys: {list(upload.keys())}")
-        except Exception as e:
-            logger.error(f"❌ Cloudinary upload failed: {e}")
-            logger.error(f"   Buffer size: {buffer_size} bytes")
-            logger.error(f"   Full traceback: {traceback.format_exc()}")
-            raise HTTPException(500, f"Cloudinary upload failed: {str(e)}")
-
-        # 9. Return successful response
+        with timer.stage("upload"):
+            try:
+                upload = cloudinary.uploader.upload(
+                    buffer,
+                    folder="pothole-detections",
+                    resource_type="image"
+                )
+                annotated_url = upload["secure_url"]
+                logger.info("✅ Cloudinary upload successful: %s", annotated_url)
+            except Exception as e:
+                logger.exception("❌ Cloudinary upload failed: %s (buffer size: %s bytes)", e, buffer_size)
+                raise HTTPException(500, f"Cloudinary upload failed: {str(e)}")
+
+        # 9. Persist detections (enqueue only; written in batches)
+        with timer.stage("store"):
+            for record in records:
+                record.image_url = annotated_url
+            store.add(records)
+
+        # 10. Return successful response
         logger.info("🎉 Detection completed successfully!")
+        outcome = "detected"
         return DetectionResponse(
             detected=True,
             confidence=confidence,
             bbox=bbox,
             annotatedImageUrl=annotated_url,
-            detectedClass="pothole"
+            detectedClass="pothole",
+            roi=roi_stats,
         )
 
     except HTTPException:
         # Re-raise HTTP exceptions as-is
         raise
     except Exception as e:
-        logger.error(f"💥 Unexpected error in detect_pothole: {e}")
-        logger.error(f"   Request URL: {request.imageUrl}")
-        logger.error(f"   Full traceback: {traceback.format_exc()}")
+        logger.exception("💥 Unexpected error in detect_pothole: %s (URL: %s)", e, request.imageUrl)
         raise HTTPException(500, f"Detection failed: {str(e)}")
+    finally:
+        total = timer.finish(outcome)
+        logger.info("⏱️ Stage timings (ms): %s, total: %.2f, outcome: %s",
+                    timer.summary_ms(), total * 1000, outcome)
+
+
+@app.get("/detections")
+def list_detections(
+    start: float | None = Query(None, description="Unix time, inclusive"),
+    end: float | None = Query(None, description="Unix time, exclusive"),
+    source: str | None = None,
+    minConfidence: float | None = Query(None, ge=0.0, le=1.0),
+    minLat: float | None = Query(None, ge=-90, le=90),
+    minLon: float | None = Query(None, ge=-180, le=180),
+    maxLat: float | None = Query(None, ge=-90, le=90),
+    maxLon: float | None = Query(None, ge=-180, le=180),
+    cursor: str | None = None,
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+):
+    bounds = (minLat, minLon, maxLat, maxLon)
+    if any(v is not None for v in bounds) and any(v is None for v in bounds):
+        raise HTTPException(400, "minLat, minLon, maxLat and maxLon must be given together")
+    try:
+        return store.query(
+            start=start,
+            end=end,
+            source=source,
+            min_confidence=minConfidence,
+            bbox=bounds if minLat is not None else None,
+            cursor=cursor,
+            limit=limit,
+        )
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+
+
+@app.get("/metrics")
+def metrics():
+    body, content_type = metrics_payload()
+    return Response(content=body, media_type=content_type)
+
+
+@app.on_event("shutdown")
+def close_store():
+    store.close()
+    logger.info("🗄️ Detection store flushed and closed")
 
 
 @app.get("/health")
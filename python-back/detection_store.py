@@ -0,0 +1,366 @@
+"""
+Persistent detection result store
+Append-optimized SQLite (WAL) table with a batched background writer and
+indexed, cursor-paginated queries by time, location, confidence and source
+"""
+
+import logging
+import math
+import os
+import queue
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = os.getenv("DETECTION_DB_PATH", "detections.db")
+BATCH_SIZE = 1000
+FLUSH_INTERVAL = 0.5  # seconds a partial batch may wait before being written
+FLUSH_TIMEOUT = 10.0  # seconds flush()/close() wait for the writer
+MAX_PAGE_SIZE = 1000
+
+# Location queries walk a (cell, ts) index over a GRID_DEGREES lat/lon grid,
+# reading one newest-first page per covered cell. Boxes spanning more than
+# MAX_GRID_CELLS cells are dense enough to scan the ts index instead.
+GRID_DEGREES = 0.01
+GRID_COLUMNS = int(round(360 / GRID_DEGREES))
+MAX_GRID_CELLS = 256
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS detections (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    source TEXT NOT NULL,
+    source_ref TEXT,
+    label TEXT NOT NULL,
+    confidence REAL NOT NULL,
+    x1 REAL NOT NULL,
+    y1 REAL NOT NULL,
+    x2 REAL NOT NULL,
+    y2 REAL NOT NULL,
+    latitude REAL,
+    longitude REAL,
+    frame INTEGER,
+    image_url TEXT,
+    cell INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_detections_ts ON detections (ts);
+CREATE INDEX IF NOT EXISTS idx_detections_source_ts ON detections (source, ts);
+CREATE INDEX IF NOT EXISTS idx_detections_confidence ON detections (confidence);
+CREATE INDEX IF NOT EXISTS idx_detections_cell_ts ON detections (cell, ts, latitude, longitude);
+"""
+
+COLUMNS = (
+    "ts", "source", "source_ref", "label", "confidence",
+    "x1", "y1", "x2", "y2", "latitude", "longitude", "frame", "image_url", "cell",
+)
+
+INSERT_SQL = f"INSERT INTO detections ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})"
+
+
+@dataclass
+class DetectionRecord:
+    source: str            # "image", "video", ...
+    label: str
+    confidence: float
+    bbox: Tuple[float, float, float, float]  # x1, y1, x2, y2 in frame pixels
+    source_ref: Optional[str] = None          # image URL or uploaded file name
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+    frame: Optional[int] = None
+    image_url: Optional[str] = None
+    ts: Optional[float] = None
+
+    def as_row(self) -> tuple:
+        x1, y1, x2, y2 = self.bbox
+        return (
+            self.ts if self.ts is not None else time.time(),
+            self.source, self.source_ref, self.label, self.confidence,
+            x1, y1, x2, y2, self.latitude, self.longitude, self.frame, self.image_url,
+            grid_cell(self.latitude, self.longitude),
+        )
+
+
+def _grid_index(latitude: float, longitude: float) -> Tuple[int, int]:
+    return (
+        int(math.floor((latitude + 90) / GRID_DEGREES)),
+        int(math.floor((longitude + 180) / GRID_DEGREES)),
+    )
+
+
+def grid_cell(latitude: Optional[float], longitude: Optional[float]) -> Optional[int]:
+    if latitude is None or longitude is None:
+        return None
+    row, col = _grid_index(latitude, longitude)
+    return row * GRID_COLUMNS + col
+
+
+def grid_cells(bbox: Tuple[float, float, float, float]) -> Optional[List[int]]:
+    """Cells covering (min_lat, min_lon, max_lat, max_lon), None if too many"""
+    min_lat, min_lon, max_lat, max_lon = bbox
+    row0, col0 = _grid_index(min_lat, min_lon)
+    row1, col1 = _grid_index(max_lat, max_lon)
+    if row1 < row0 or col1 < col0:
+        return []
+    if (row1 - row0 + 1) * (col1 - col0 + 1) > MAX_GRID_CELLS:
+        return None
+    return [r * GRID_COLUMNS + c for r in range(row0, row1 + 1) for c in range(col0, col1 + 1)]
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class DetectionStore:
+    """
+    Request handlers call add(), which only enqueues rows; a writer thread
+    commits them in batches of roughly BATCH_SIZE rows per transaction.
+    """
+
+    def __init__(self, path: str = DB_PATH, batch_size: int = BATCH_SIZE,
+                 flush_interval: float = FLUSH_INTERVAL):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._write_conn = _connect(path)
+        self._write_conn.executescript(SCHEMA)
+        self._readers = threading.local()
+
+        self._queue: queue.Queue = queue.Queue()
+        self._writer = threading.Thread(target=self._run, name="detection-store-writer", daemon=True)
+        self._writer.start()
+
+    # -------------------------
+    # Writes
+    # -------------------------
+    def add(self, records: Iterable[DetectionRecord]) -> int:
+        rows = [record.as_row() for record in records]
+        if rows:
+            self._queue.put(rows)
+        return len(rows)
+
+    def flush(self, timeout: Optional[float] = FLUSH_TIMEOUT) -> bool:
+        """Wait until every row enqueued so far is committed; False on timeout"""
+        if not self._writer.is_alive():
+            logger.warning("⚠️ Detection store writer is not running; %d pending batches not written",
+                           self._queue.qsize())
+            return False
+        done = threading.Event()
+        self._queue.put(done)
+        if not done.wait(timeout):
+            logger.warning("⚠️ Detection store flush timed out after %ss", timeout)
+            return False
+        return True
+
+    def close(self, timeout: float = FLUSH_TIMEOUT) -> None:
+        """Drain pending rows (the stop marker queues behind them) and stop the writer"""
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join(timeout)
+            if self._writer.is_alive():
+                logger.warning("⚠️ Detection store writer did not stop within %.1fs", timeout)
+                return
+        self._write_conn.close()
+
+    def _run(self) -> None:
+        while True:
+            batch: List[tuple] = []
+            waiters: List[threading.Event] = []
+            stop = False
+            item = self._queue.get()
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if item is None:
+                    stop = True
+                    break
+                if isinstance(item, threading.Event):
+                    waiters.append(item)
+                    break
+                batch.extend(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+
+            if batch:
+                try:
+                    with self._write_conn:
+                        self._write_conn.executemany(INSERT_SQL, batch)
+                except Exception:
+                    logger.exception("❌ Failed to persist %d detections", len(batch))
+            for waiter in waiters:
+                waiter.set()
+            if stop:
+                return
+
+    # -------------------------
+    # Reads
+    # -------------------------
+    def _reader(self) -> sqlite3.Connection:
+        conn = getattr(self._readers, "conn", None)
+        if conn is None:
+            conn = _connect(self.path)
+            self._readers.conn = conn
+        return conn
+
+    def query(
+        self,
+        start: Optional[float] = None,
+        end: Optional[float] = None,
+        source: Optional[str] = None,
+        min_confidence: Optional[float] = None,
+        bbox: Optional[Tuple[float, float, float, float]] = None,
+        cursor: Optional[str] = None,
+        limit: int = 100,
+    ) -> Dict:
+        """
+        Newest-first page of detections.
+        bbox is (min_lat, min_lon, max_lat, max_lon); cursor is the
+        next_cursor value returned by the previous page.
+        """
+        # Named parameters: the grid path repeats the filters once per cell,
+        # but each name is still a single bound variable
+        clauses: List[str] = []
+        params: Dict[str, object] = {}
+        if start is not None:
+            clauses.append("ts >= :start")
+            params["start"] = start
+        if end is not None:
+            clauses.append("ts < :end")
+            params["end"] = end
+        if source is not None:
+            clauses.append("source = :source")
+            params["source"] = source
+        if min_confidence is not None:
+            clauses.append("confidence >= :min_confidence")
+            params["min_confidence"] = min_confidence
+        if bbox is not None:
+            clauses.append("latitude BETWEEN :min_lat AND :max_lat "
+                           "AND longitude BETWEEN :min_lon AND :max_lon")
+            params.update(zip(("min_lat", "min_lon", "max_lat", "max_lon"), bbox))
+        if cursor:
+            cursor_ts, cursor_id = decode_cursor(cursor)
+            # Row-value comparison keeps the (ts, id) index range scan
+            clauses.append("(ts, id) < (:cursor_ts, :cursor_id)")
+            params.update(cursor_ts=cursor_ts, cursor_id=cursor_id)
+
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        params["limit"] = limit + 1
+        order = "ORDER BY ts DESC, id DESC"
+        cells = grid_cells(bbox) if bbox is not None else None
+        if cells:
+            # Newest limit+1 matches per cell via (cell, ts), then merge.
+            # Cell ids come from grid_cells(), so they are inlined as integers.
+            per_cell = [
+                f"SELECT * FROM (SELECT id, ts FROM detections "
+                f"WHERE {' AND '.join([f'cell = {int(cell)}', *clauses])} {order} LIMIT :limit)"
+                for cell in cells
+            ]
+            sql = (f"SELECT * FROM detections WHERE id IN "
+                   f"(SELECT id FROM ({' UNION ALL '.join(per_cell)}) {order} LIMIT :limit) {order}")
+        elif cells == []:
+            return {"items": [], "next_cursor": None}
+        else:
+            where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+            sql = f"SELECT * FROM detections {where} {order} LIMIT :limit"
+        rows = self._reader().execute(sql, params).fetchall()
+
+        items = [_row_to_dict(r) for r in rows[:limit]]
+        next_cursor = None
+        if len(rows) > limit:
+            last = rows[limit - 1]
+            next_cursor = encode_cursor(last["ts"], last["id"])
+        return {"items": items, "next_cursor": next_cursor}
+
+
+def encode_cursor(ts: float, row_id: int) -> str:
+    return f"{ts!r}_{row_id}"
+
+
+def decode_cursor(cursor: str) -> Tuple[float, int]:
+    try:
+        ts, row_id = cursor.rsplit("_", 1)
+        return float(ts), int(row_id)
+    except ValueError:
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+
+def _row_to_dict(row: sqlite3.Row) -> Dict:
+    d = dict(row)
+    d["bbox"] = [d.pop("x1"), d.pop("y1"), d.pop("x2"), d.pop("y2")]
+    d.pop("cell", None)
+    return d
+
+
+if __name__ == "__main__":
+    # Write/query benchmark: python detection_store.py [rows] [db_path]
+    import random
+    import sys
+
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000_000
+    path = sys.argv[2] if len(sys.argv) > 2 else "bench_detections.db"
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+    store = DetectionStore(path, batch_size=10_000)
+    now = time.time()
+    span = 90 * 24 * 3600  # 90 days of history
+    rng = random.Random(0)
+
+    start = time.perf_counter()
+    chunk = 100_000
+    for offset in range(0, rows, chunk):
+        n = min(chunk, rows - offset)
+        store.add(
+            DetectionRecord(
+                source=rng.choice(("image", "video")),
+                label="pothole",
+                confidence=rng.random(),
+                bbox=(10.0, 20.0, 110.0, 90.0),
+                latitude=18.9 + rng.random() * 0.3,   # Mumbai
+                longitude=72.8 + rng.random() * 0.2,
+                ts=now - span + (offset + i) * span / rows,
+            )
+            for i in range(n)
+        )
+    store.flush(timeout=None)
+    elapsed = time.perf_counter() - start
+    print(f"Wrote {rows:,} rows in {elapsed:.1f}s ({rows / elapsed:,.0f} rows/s)")
+
+    cases = {
+        "latest page": {},
+        "last 24h": {"start": now - 24 * 3600},
+        "source=video": {"source": "video"},
+        "confidence>=0.9": {"min_confidence": 0.9},
+        "geo 0.002deg box": {"bbox": (19.0, 72.85, 19.002, 72.852)},
+        "geo 0.02deg box": {"bbox": (19.0, 72.85, 19.02, 72.87)},
+        "geo 0.02deg box + 24h": {"start": now - 24 * 3600, "bbox": (19.0, 72.85, 19.02, 72.87)},
+        "geo 0.1deg box": {"bbox": (19.0, 72.85, 19.1, 72.95)},
+        "geo city-wide box": {"bbox": (18.9, 72.8, 19.2, 73.0)},
+        "24h + video + conf>=0.5": {"start": now - 24 * 3600, "source": "video", "min_confidence": 0.5},
+    }
+    for name, filters in cases.items():
+        timings = []
+        cursor = None
+        for _ in range(20):
+            t0 = time.perf_counter()
+            page = store.query(cursor=cursor, limit=100, **filters)
+            timings.append(time.perf_counter() - t0)
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+        timings.sort()
+        print(f"{name:<26} p50 {timings[len(timings) // 2] * 1000:7.2f} ms  "
+              f"max {timings[-1] * 1000:7.2f} ms  ({len(timings)} pages)")
+    store.close()
@@ -0,0 +1,179 @@
+"""
+Request instrumentation for the Pothole Detection API
+Non-blocking queue-based logging with sampling, per-stage timings,
+and Prometheus histograms exported on /metrics
+"""
+
+import atexit
+import copy
+import logging
+import os
+import queue
+import random
+import sys
+import time
+import traceback
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, generate_latest
+
+LOG_FILE = os.getenv("DETECTION_LOG_FILE", "detection.log")
+LOG_LEVEL = os.getenv("DETECTION_LOG_LEVEL", "INFO").upper()
+# Fraction of DEBUG/INFO records kept; WARNING and above are never dropped
+LOG_SAMPLE_RATE = float(os.getenv("DETECTION_LOG_SAMPLE_RATE", "1.0"))
+# Records waiting for the listener; further records are dropped when full
+LOG_QUEUE_SIZE = int(os.getenv("DETECTION_LOG_QUEUE_SIZE", "10000"))
+
+# Buckets cover sub-millisecond decode up to multi-second CPU inference/upload
+STAGE_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+)
+
+STAGE_LATENCY = Histogram(
+    "pothole_stage_duration_seconds",
+    "Time spent in each detection pipeline stage",
+    ["endpoint", "stage"],
+    buckets=STAGE_BUCKETS,
+)
+REQUEST_LATENCY = Histogram(
+    "pothole_request_duration_seconds",
+    "End-to-end detection request latency",
+    ["endpoint", "outcome"],
+    buckets=STAGE_BUCKETS,
+)
+REQUESTS_TOTAL = Counter(
+    "pothole_requests_total",
+    "Detection requests by outcome",
+    ["endpoint", "outcome"],
+)
+LOG_RECORDS_DROPPED = Counter(
+    "pothole_log_records_dropped_total",
+    "Log records dropped because the log queue was full",
+)
+
+
+class SamplingFilter(logging.Filter):
+    """Keep a random fraction of low-severity records, all warnings and errors"""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = max(0.0, min(1.0, rate))
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or self.rate >= 1.0:
+            return True
+        return random.random() < self.rate
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    Enqueue a copy of each record with its message already interpolated
+    (cheap, and pins argument values at call time). Tracebacks are reduced
+    to frame summaries, which releases the request's frames; rendering them
+    to text is left to DeferredTracebackFormatter on the listener thread.
+    Records are dropped, not blocked on, when the queue is full.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_summary = traceback.TracebackException(
+                    *record.exc_info, lookup_lines=False
+                )
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+
+class DeferredTracebackFormatter(logging.Formatter):
+    """Renders tracebacks captured by DeferredQueueHandler"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        summary = getattr(record, "exc_summary", None)
+        if summary is not None and not record.exc_text:
+            record.exc_text = "".join(summary.format()).rstrip("\n")
+        return super().format(record)
+
+
+class _BoundedQueueListener(QueueListener):
+    def enqueue_sentinel(self) -> None:
+        # Block rather than fail if the queue is full at shutdown
+        self.queue.put(self._sentinel)
+
+
+def setup_logging(
+    log_file: str = LOG_FILE,
+    level: str = LOG_LEVEL,
+    sample_rate: float = LOG_SAMPLE_RATE,
+) -> QueueListener:
+    """
+    Route root logging through an in-memory queue.
+    Request handlers only enqueue records; a background thread does the
+    formatting and the stdout/file I/O.
+    """
+    formatter = DeferredTracebackFormatter(
+        '%(asctime)s - %(name)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s'
+    )
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(formatter)
+    file_handler = logging.FileHandler(log_file, mode='a')
+    file_handler.setFormatter(formatter)
+
+    log_queue: queue.Queue = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(sample_rate))
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(level)
+
+    listener = _BoundedQueueListener(
+        log_queue, stream_handler, file_handler, respect_handler_level=True
+    )
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+class StageTimer:
+    """Collects per-stage wall-clock timings for a single request"""
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.timings: Dict[str, float] = {}
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.timings[name] = self.timings.get(name, 0.0) + elapsed
+            STAGE_LATENCY.labels(self.endpoint, name).observe(elapsed)
+
+    def finish(self, outcome: str) -> float:
+        total = time.perf_counter() - self._start
+        REQUEST_LATENCY.labels(self.endpoint, outcome).observe(total)
+        REQUESTS_TOTAL.labels(self.endpoint, outcome).inc()
+        return total
+
+    def summary_ms(self) -> Dict[str, float]:
+        return {name: round(t * 1000, 2) for name, t in self.timings.items()}
+
+
+def metrics_payload():
+    """Prometheus exposition body and content type"""
+    return generate_latest(), CONTENT_TYPE_LATEST
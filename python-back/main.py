@@ -1,53 +1,137 @@
-from fastapi import FastAPI, UploadFile, File
+from fastapi import FastAPI, UploadFile, File, Form
 from ultralytics import YOLO
 import cv2
 import numpy as np
 import io
+import os
+import time
+import uuid
 from PIL import Image
+from roi import RoadMaskCache, compute_roi
+from detection_store import DetectionRecord, DetectionStore
 
 app = FastAPI(title="Mumbai Smart Infrastructure API")
 
 # Load your successful model
 model = YOLO("https://huggingface.co/peterhdd/pothole-detection-yolov8/resolve/main/best.pt")
 
-def get_detections(results):
-    """Helper to extract coordinates and classes"""
+# Road masks, cached per camera / video stream
+roi_cache = RoadMaskCache()
+
+# Shared detection store (query it through api.py's /detections)
+store = DetectionStore()
+
+@app.on_event("shutdown")
+def close_store():
+    store.close()
+
+def get_detections(results, roi=None):
+    """Helper to extract full-precision coordinates and classes, mapped back from an ROI crop"""
     detections = []
     for r in results:
         for box in r.boxes:
             # Get coordinates in [x1, y1, x2, y2] format
             coords = box.xyxy[0].tolist()
+            if roi is not None:
+                coords = roi.to_original(coords)
+                if not roi.contains(coords):
+                    continue  # Outside the camera polygon
             conf = float(box.conf[0])
             cls = int(box.cls[0])
             label = r.names[cls]
             
             detections.append({
                 "label": label,
-                "confidence": round(conf, 2),
-                "bbox": [round(x) for x in coords] # Rounded for cleaner JSON
+                "confidence": conf,
+                "bbox": coords
             })
     return detections
 
+def to_json(detections):
+    """Rounded copies of get_detections() output for cleaner JSON"""
+    return [
+        {
+            "label": d["label"],
+            "confidence": round(d["confidence"], 2),
+            "bbox": [round(x) for x in d["bbox"]]
+        }
+        for d in detections
+    ]
+
+def to_records(detections, source, source_ref, latitude=None, longitude=None, frame=None):
+    """Wrap get_detections() output for the detection store"""
+    return [
+        DetectionRecord(
+            source=source,
+            label=d["label"],
+            confidence=d["confidence"],
+            bbox=tuple(d["bbox"]),
+            source_ref=source_ref,
+            latitude=latitude,
+            longitude=longitude,
+            frame=frame,
+        )
+        for d in detections
+    ]
+
+def roi_summary(roi, inference_time):
+    """Pixel reduction and speedup report for an ROI-cropped request"""
+    return {
+        "source": roi.source,
+        "bounds": list(roi.bounds),
+        "pixel_reduction": round(roi.pixel_reduction, 4),
+        "estimated_speedup": round(roi.estimated_speedup, 2),
+        "inference_seconds": round(inference_time, 4),
+    }
+
 @app.post("/detect/image")
-async def detect_image(file: UploadFile = File(...)):
+async def detect_image(
+    file: UploadFile = File(...),
+    use_roi: bool = Form(False),
+    camera_id: str | None = Form(None),
+    latitude: float | None = Form(None, ge=-90, le=90),
+    longitude: float | None = Form(None, ge=-180, le=180),
+):
     # Read image
     contents = await file.read()
     img = Image.open(io.BytesIO(contents)).convert("RGB")
     img_array = np.array(img)
 
+    # Optionally crop to the road surface before inference
+    roi = None
+    if use_roi:
+        # Cached mask only for configured cameras, otherwise per request
+        roi = roi_cache.for_camera(camera_id, img_array) or compute_roi(img_array)
+        img_array = roi.crop(img_array)
+
     # Run Inference
+    start = time.perf_counter()
     results = model.predict(img_array, device='cpu', conf=0.25)
-    detections = get_detections(results)
+    inference_time = time.perf_counter() - start
+    detections = get_detections(results, roi)
+    store.add(to_records(detections, "image", file.filename, latitude, longitude))
+
+    response = {"status": "success", "data": to_json(detections)}
+    if roi is not None:
+        response["roi"] = roi_summary(roi, inference_time)
 
     if not detections:
-        return {"status": "success", "message": "No potholes detected", "data": []}
+        return {**response, "message": "No potholes detected"}
     
-    return {"status": "success", "message": f"Found {len(detections)} potholes", "data": detections}
+    return {**response, "message": f"Found {len(detections)} potholes"}
 
 @app.post("/detect/video")
-async def detect_video(file: UploadFile = File(...)):
-    # Save video temporarily to process
-    temp_path = f"temp_{file.filename}"
+async def detect_video(
+    file: UploadFile = File(...),
+    use_roi: bool = Form(False),
+    camera_id: str | None = Form(None),
+    latitude: float | None = Form(None, ge=-90, le=90),
+    longitude: float | None = Form(None, ge=-180, le=180),
+):
+    # Save video temporarily to process; request-unique so concurrent
+    # uploads with the same filename never share a file or cached mask
+    request_id = uuid.uuid4().hex
+    temp_path = f"temp_{request_id}_{file.filename}"
     with open(temp_path, "wb") as f:
         f.write(await file.read())
 
@@ -55,24 +139,40 @@ async def detect_video(file: UploadFile = File(...)):
     total_detections = 0
     unique_potholes = [] # Simplified tracking logic
 
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if not ret:
-            break
-        
-        # We only process every 5th frame to save CPU time for Mumbai traffic
-        if int(cap.get(cv2.CAP_PROP_POS_FRAMES)) % 5 == 0:
-            res = model.predict(frame, device='cpu', conf=0.3)
-            current_frame_dets = get_detections(res)
-            total_detections += len(current_frame_dets)
-            # You could add logic here to deduplicate or save coordinates
-
-    cap.release()
-    import os
-    os.remove(temp_path) # Clean up
+    # ROI mask is computed on the first processed frame and reused for the stream
+    stream_key = f"video:{request_id}"
+    roi = None
+    inference_time = 0.0
 
-    return {
+    try:
+        while cap.isOpened():
+            ret, frame = cap.read()
+            if not ret:
+                break
+
+            # We only process every 5th frame to save CPU time for Mumbai traffic
+            frame_idx = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+            if frame_idx % 5 == 0:
+                if use_roi:
+                    roi = roi_cache.for_camera(camera_id, frame) or roi_cache.get(stream_key, frame)
+                    frame = roi.crop(frame)
+                start = time.perf_counter()
+                res = model.predict(frame, device='cpu', conf=0.3)
+                inference_time += time.perf_counter() - start
+                current_frame_dets = get_detections(res, roi)
+                total_detections += len(current_frame_dets)
+                # Store batches the writes; this only enqueues
+                store.add(to_records(current_frame_dets, "video", file.filename, latitude, longitude, frame_idx))
+    finally:
+        cap.release()
+        os.remove(temp_path) # Clean up
+        roi_cache.evict(stream_key) # Per-upload masks are not reused
+
+    response = {
         "status": "success",
         "total_detections_found": total_detections,
         "summary": "Video processed. Coordinates archived to database." if total_detections > 0 else "No issues detected."
-    }
\ No newline at end of file
+    }
+    if roi is not None:
+        response["roi"] = roi_summary(roi, inference_time)
+    return response
\ No newline at end of file
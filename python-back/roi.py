@@ -0,0 +1,249 @@
+"""
+Region-of-interest road masking
+Restricts YOLO inference to the road surface of a dashcam frame, either from a
+fixed per-camera polygon or a cheap colour heuristic, and maps boxes back to
+original image coordinates
+"""
+
+import json
+import math
+import os
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+# JSON file mapping camera id -> polygon as [[x, y], ...] in 0..1 frame units
+ROI_CAMERA_CONFIG = os.getenv("ROI_CAMERA_CONFIG", "roi_cameras.json")
+
+# Heuristic tuning: rows above the horizon are never road
+HORIZON_FRACTION = 0.4
+SAMPLE_STRIDE = 8
+MAX_ROAD_SATURATION = 40
+MIN_ROAD_BRIGHTNESS = 40
+MAX_ROAD_BRIGHTNESS = 210
+MIN_ROAD_COVERAGE = 0.05
+PAD_FRACTION = 0.03
+
+# Minimum share of a box that must overlap a polygon mask to be kept
+MIN_ROAD_OVERLAP = 0.25
+
+# Upper bound on cached masks (each is a full HxW bool array)
+MAX_CACHED_MASKS = 32
+
+# Mirrors YOLO letterboxing, used to estimate inference cost of a crop
+MODEL_IMGSZ = 640
+MODEL_STRIDE = 32
+
+Polygon = Sequence[Sequence[float]]
+Bounds = Tuple[int, int, int, int]
+
+
+@dataclass
+class RoadROI:
+    mask: np.ndarray  # HxW bool, True on road pixels
+    bounds: Bounds    # x0, y0, x1, y1 (exclusive) crop in original pixels
+    source: str       # "polygon" or "heuristic"
+
+    @property
+    def pixel_reduction(self) -> float:
+        """Fraction of frame pixels skipped by cropping to bounds"""
+        h, w = self.mask.shape
+        x0, y0, x1, y1 = self.bounds
+        return 1.0 - ((x1 - x0) * (y1 - y0)) / float(h * w)
+
+    @property
+    def estimated_speedup(self) -> float:
+        """Ratio of letterboxed network input area, full frame vs crop"""
+        h, w = self.mask.shape
+        x0, y0, x1, y1 = self.bounds
+        return _network_area(h, w) / _network_area(y1 - y0, x1 - x0)
+
+    def crop(self, image: np.ndarray) -> np.ndarray:
+        x0, y0, x1, y1 = self.bounds
+        return np.ascontiguousarray(image[y0:y1, x0:x1])
+
+    def to_original(self, xyxy: Sequence[float]) -> List[float]:
+        """Shift a crop-space [x1, y1, x2, y2] box back into frame coordinates"""
+        x0, y0, _, _ = self.bounds
+        return [xyxy[0] + x0, xyxy[1] + y0, xyxy[2] + x0, xyxy[3] + y0]
+
+    def contains(self, xyxy: Sequence[float]) -> bool:
+        """
+        True if a frame-space box overlaps the road enough to keep.
+        Only polygon masks filter: the heuristic marks dark, wet or muddy
+        patches as non-road, which is exactly where potholes are.
+        """
+        if self.source != "polygon":
+            return True
+        h, w = self.mask.shape
+        x1 = min(max(int(xyxy[0]), 0), w - 1)
+        y1 = min(max(int(xyxy[1]), 0), h - 1)
+        x2 = min(max(int(math.ceil(xyxy[2])), x1 + 1), w)
+        y2 = min(max(int(math.ceil(xyxy[3])), y1 + 1), h)
+        return float(self.mask[y1:y2, x1:x2].mean()) >= MIN_ROAD_OVERLAP
+
+
+def _network_area(h: int, w: int) -> int:
+    r = MODEL_IMGSZ / max(h, w)
+    nh = math.ceil(h * r / MODEL_STRIDE) * MODEL_STRIDE
+    nw = math.ceil(w * r / MODEL_STRIDE) * MODEL_STRIDE
+    return nh * nw
+
+
+def _mask_bounds(mask: np.ndarray) -> Optional[Bounds]:
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if rows.size == 0 or cols.size == 0:
+        return None
+    h, w = mask.shape
+    pad_y = int(h * PAD_FRACTION)
+    pad_x = int(w * PAD_FRACTION)
+    return (
+        max(int(cols[0]) - pad_x, 0),
+        max(int(rows[0]) - pad_y, 0),
+        min(int(cols[-1]) + 1 + pad_x, w),
+        min(int(rows[-1]) + 1 + pad_y, h),
+    )
+
+
+def polygon_mask(shape: Tuple[int, int], polygon: Polygon) -> np.ndarray:
+    """Rasterise a normalised [[x, y], ...] polygon to an HxW bool mask"""
+    h, w = shape
+    points = [(float(x) * w, float(y) * h) for x, y in polygon]
+    canvas = Image.new("L", (w, h), 0)
+    ImageDraw.Draw(canvas).polygon(points, fill=1)
+    return np.asarray(canvas, dtype=bool)
+
+
+def heuristic_mask(image: np.ndarray) -> np.ndarray:
+    """
+    Cheap road segmentation: low-saturation, mid-brightness pixels below the
+    horizon, evaluated on a strided sample and upscaled. Falls back to the
+    whole region below the horizon when too little road is found.
+    """
+    h, w = image.shape[:2]
+    horizon = int(h * HORIZON_FRACTION)
+    sample = image[horizon::SAMPLE_STRIDE, ::SAMPLE_STRIDE].astype(np.int16)
+    hi = sample.max(axis=2)
+    lo = sample.min(axis=2)
+    road = (
+        (hi - lo <= MAX_ROAD_SATURATION)
+        & (hi >= MIN_ROAD_BRIGHTNESS)
+        & (hi <= MAX_ROAD_BRIGHTNESS)
+    )
+
+    mask = np.zeros((h, w), dtype=bool)
+    if road.mean() < MIN_ROAD_COVERAGE:
+        mask[horizon:, :] = True
+        return mask
+
+    full = np.repeat(np.repeat(road, SAMPLE_STRIDE, axis=0), SAMPLE_STRIDE, axis=1)
+    mask[horizon:, :] = full[: h - horizon, :w]
+    return mask
+
+
+def load_camera_polygons(path: str = ROI_CAMERA_CONFIG) -> Dict[str, Polygon]:
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def compute_roi(
+    image: np.ndarray,
+    polygon: Optional[Polygon] = None,
+) -> RoadROI:
+    """Build a road ROI from an explicit polygon, or the heuristic if none"""
+    shape = image.shape[:2]
+    if polygon:
+        mask, source = polygon_mask(shape, polygon), "polygon"
+    else:
+        mask, source = heuristic_mask(image), "heuristic"
+
+    bounds = _mask_bounds(mask)
+    if bounds is None:
+        # Empty polygon/mask: fall back to the full frame
+        mask = np.ones(shape, dtype=bool)
+        bounds = (0, 0, shape[1], shape[0])
+    roi = RoadROI(mask=mask, bounds=bounds, source=source)
+    if roi.estimated_speedup < 1.0:
+        # Letterboxing can make a squarer crop cost more than the full frame
+        # (e.g. portrait images); keep the mask but run on the whole frame
+        roi.bounds = (0, 0, shape[1], shape[0])
+    return roi
+
+
+class RoadMaskCache:
+    """
+    Bounded LRU of ROIs keyed by (stream, frame shape). Camera entries are
+    only created for ids configured in ROI_CAMERA_CONFIG, so client-supplied
+    ids cannot grow the cache or reuse one image's heuristic mask.
+    """
+
+    def __init__(self, camera_polygons: Optional[Dict[str, Polygon]] = None,
+                 max_entries: int = MAX_CACHED_MASKS):
+        self.camera_polygons = camera_polygons if camera_polygons is not None else load_camera_polygons()
+        self.max_entries = max_entries
+        self._cache: "OrderedDict[Tuple[str, Tuple[int, int]], RoadROI]" = OrderedDict()
+
+    def get(
+        self,
+        stream_key: str,
+        image: np.ndarray,
+        polygon: Optional[Polygon] = None,
+    ) -> RoadROI:
+        key = (stream_key, image.shape[:2])
+        roi = self._cache.get(key)
+        if roi is None:
+            roi = compute_roi(image, polygon)
+            self._cache[key] = roi
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(key)
+        return roi
+
+    def for_camera(self, camera_id: Optional[str], image: np.ndarray) -> Optional[RoadROI]:
+        """Cached polygon ROI for a configured camera, None for unknown ids"""
+        polygon = self.camera_polygons.get(camera_id) if camera_id else None
+        if polygon is None:
+            return None
+        return self.get(f"camera:{camera_id}", image, polygon)
+
+    def evict(self, stream_key: str) -> None:
+        for key in [k for k in self._cache if k[0] == stream_key]:
+            del self._cache[key]
+
+
+if __name__ == "__main__":
+    # Measure real speedup: python roi.py image.jpg [camera_id] [model]
+    import sys
+    import time
+
+    from ultralytics import YOLO
+
+    MODEL_URL = "https://huggingface.co/peterhdd/pothole-detection-yolov8/resolve/main/best.pt"
+    runs = 10
+
+    frame = np.array(Image.open(sys.argv[1]).convert("RGB"))
+    camera = sys.argv[2] if len(sys.argv) > 2 else None
+    roi = compute_roi(frame, load_camera_polygons().get(camera) if camera else None)
+    model = YOLO(sys.argv[3] if len(sys.argv) > 3 else MODEL_URL)
+    model.predict(frame, device="cpu", verbose=False)  # warm-up
+
+    def timed(img):
+        start = time.perf_counter()
+        for _ in range(runs):
+            res = model.predict(img, device="cpu", conf=0.20, verbose=False)
+        return (time.perf_counter() - start) / runs, len(res[0].boxes)
+
+    full_t, full_n = timed(frame)
+    roi_t, roi_n = timed(roi.crop(frame))
+    print(f"ROI source: {roi.source}, bounds: {roi.bounds}")
+    print(f"Pixel reduction: {roi.pixel_reduction:.1%}, estimated speedup: {roi.estimated_speedup:.2f}x")
+    print(f"Full frame: {full_t * 1000:.1f} ms ({full_n} boxes)")
+    print(f"ROI crop:   {roi_t * 1000:.1f} ms ({roi_n} boxes)")
+    print(f"Measured speedup: {full_t / roi_t:.2f}x")